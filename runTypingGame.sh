@@ -62,6 +62,10 @@ VENV_PIP="$VENV_DIR/bin/pip"
 echo "Installing 'paho-mqtt' package..."
 "$VENV_PIP" install paho-mqtt
 
+# orjson is optional (faster message encoding); the game falls back to json without it.
+echo "Installing optional 'orjson' package..."
+"$VENV_PIP" install orjson || echo "Could not install 'orjson'; continuing without it."
+
 # 4. Run the game using the explicit path to the venv's Python interpreter.
 echo "Starting Terminal Velocity..."
 "$VENV_PYTHON" "$GAME_SCRIPT"
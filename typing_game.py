@@ -2,11 +2,33 @@ import curses
 import time
 import random
 import json
+import struct
+import heapq
+import queue
 import uuid
 import os
 import paho.mqtt.client as mqtt
 from threading import Thread, Event
-from datetime import datetime
+
+# orjson is an optional speedup; fall back to the stdlib json module without it.
+# Either way json_dumps returns bytes, which paho publishes without re-encoding.
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+
+    def json_dumps_indented(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    # Match orjson's compact, UTF-8 output: no spaces and no \u escapes
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+    def json_dumps_indented(obj):
+        return json.dumps(obj, indent=2).encode()
+
+    json_loads = json.loads
 
 # --- Game Configuration ---
 TEXT_TO_TYPE = [
@@ -19,82 +41,167 @@ TEXT_TO_TYPE = [
 MQTT_BROKER = "broker.hivemq.com"
 MQTT_PORT = 1883
 LEADERBOARD_FILE = "leaderboard.json"
-
-# --- Global State (managed by the network thread) ---
-opponent_state = {
-    "wpm": 0,
-    "progress": 0,
-    "accuracy": 100,
-    "finished": False,
-    "winner": False,
-    "name": "Opponent"
-}
+# Game-loop timing uses integer nanoseconds from time.monotonic_ns()
+FRAME_INTERVAL_NS = 1_000_000_000 // 30 # Redraw the game screen at most 30 times per second
+PROGRESS_INTERVAL_NS = 200_000_000 # Time between progress updates sent to the opponent
+# WPM is (chars / 5) / (ns / 60e9), i.e. chars * WPM_FACTOR / ns
+WPM_FACTOR = 60_000_000_000 / 5
+
+# --- Message Schema ---
+# Every message starts with a tag byte saying what it is:
+#   TAG_JOIN: the joining player's name as UTF-8
+#   TAG_START: JSON {"n": host name, "t": text to type}
+#   TAG_PROGRESS, TAG_GAMEOVER: STATS_PACKET, the sender's running or final stats
+TAG_JOIN = 1
+TAG_START = 2
+TAG_PROGRESS = 3
+TAG_GAMEOVER = 4
+# Tag, flags, then WPM, progress and accuracy (the last two in tenths of a percent)
+STATS_PACKET = struct.Struct('<BBHHH')
+STATS_FROM_HOST = 0x01 # Flag: sent by the host (tells our own echoes apart)
+STATS_FINISHED = 0x02 # Flag: the sender has finished typing
+
+# --- Global State (shared between the network thread and the game loop) ---
+class OpponentState:
+    """ The opponent's name and latest stats, as shown on screen. """
+    # Fixed slots instead of a dict: the game loop reads these on every frame
+    __slots__ = ("wpm", "progress", "accuracy", "finished", "winner", "name")
+
+    def __init__(self):
+        self.wpm = 0
+        self.progress = 0
+        self.accuracy = 100
+        self.finished = False
+        self.winner = False
+        self.name = "Opponent"
+
+# The network thread only writes opponent_state and game_text before
+# game_started_event is set; after that, every message is handed to the
+# game loop through received_messages, so the game loop is the only thread
+# touching them and no lock is needed.
+opponent_state = OpponentState()
 game_started_event = Event()
+game_over_event = Event() # Set when both players have finished; later messages are dropped
+received_messages = queue.SimpleQueue() # Payloads for the game loop once the game has started
 game_text = ""
+# Derived from game_text by set_game_text, so hot paths don't recompute them
+game_text_bytes = b"" # game_text as one byte per character
+game_text_len = 0
+progress_per_char = 0.0 # 100 / game_text_len: the percentage of the passage one character is worth
+# game_text wrapped to "width" columns: its lines, and each character's screen row and column.
+# Lines are cut at exactly "width" characters rather than at word boundaries
+# (as textwrap would), so a character's cell follows from its index alone.
+wrap_cache = {"width": None, "lines": [], "rows": [], "cols": []}
 player_name = ""
 
+def set_game_text(text):
+    """ Sets the text to type along with the values derived from it. """
+    global game_text, game_text_bytes, game_text_len, progress_per_char
+    game_text = text
+    # Typed text is kept as a bytearray and the passage is only ASCII,
+    # so it is compared byte for byte.
+    game_text_bytes = text.encode('ascii', 'replace')
+    game_text_len = len(text)
+    progress_per_char = 100 / game_text_len if game_text_len else 0.0
+    wrap_cache["width"] = None # Rewrap the new text on the next full repaint
+
 # --- MQTT Network Handling ---
 def network_thread_logic(client, topic):
     """ The main loop for the MQTT client to process messages. """
+    # Caveat: because paho isn't managing this thread (no loop_start()),
+    # publish() called from the game loop writes to the socket on the game
+    # thread while loop_forever() may be writing here, and paho doesn't lock
+    # its output queue. client.loop_start() is the thread-safe way to run
+    # this loop if that ever matters.
     client.loop_forever()
 
 def on_connect(client, userdata, flags, rc, properties=None):
     """ Callback for when the client connects to the broker. """
     if rc == 0:
         topic = userdata['topic']
-        client.subscribe(topic)
+        # QoS 1 so the broker delivers the QoS 1 messages (start and finish)
+        # to us at QoS 1 too; progress updates are still published at QoS 0.
+        client.subscribe(topic, qos=1)
     else:
         pass
 
 def on_message(client, userdata, msg):
     """ Callback for when a message is received from the broker. """
-    global opponent_state, game_text
+    # Nothing can change the outcome once both players are done, and the
+    # game loop no longer drains the queue, so drop late messages unread.
+    if game_over_event.is_set():
+        return
+    # Once the game is running, hand payloads to the game loop rather than
+    # decoding them here, so the network thread is free for the next message.
+    if game_started_event.is_set():
+        received_messages.put(msg.payload)
+    else:
+        handle_message(client, userdata, msg.payload)
+
+def handle_join(client, userdata, payload):
+    """ Host receives join message with player name from client. """
+    if userdata["is_host"]:
+        opponent_state.name = payload[1:].decode('utf-8', 'replace') or "Opponent"
+        client.publish(userdata["topic"], userdata["start_message"], qos=1)
+        game_started_event.set()
+    return False
+
+def handle_start(client, userdata, payload):
+    """ Client receives the game text and host's name. """
+    if not userdata["is_host"]:
+        data = json_loads(payload[1:])
+        # An empty text would count as finished on the first key press
+        if not isinstance(data["t"], str) or not data["t"]:
+            return False
+        set_game_text(data["t"])
+        opponent_state.name = data.get("n", "Opponent")
+        game_started_event.set()
+    return False
+
+def handle_progress(client, userdata, payload):
+    """ Applies the opponent's running stats. """
+    _, flags, wpm, progress, accuracy = STATS_PACKET.unpack(payload)
+    # Ignore messages sent by ourselves (if broker echoes them)
+    if bool(flags & STATS_FROM_HOST) == userdata["is_host"]:
+        return False
+    # Only update running stats if the opponent isn't marked as finished yet
+    if not opponent_state.finished:
+        opponent_state.wpm = wpm
+        opponent_state.progress = progress / 10
+        opponent_state.accuracy = accuracy / 10
+    # If the loser sends a final update saying they are finished, mark them as such
+    if flags & STATS_FINISHED:
+        opponent_state.finished = True
+    return True
+
+def handle_gameover(client, userdata, payload):
+    """ Marks the opponent as the winner, with their final stats. """
+    _, flags, wpm, progress, accuracy = STATS_PACKET.unpack(payload)
+    if bool(flags & STATS_FROM_HOST) == userdata["is_host"]:
+        return False
+    # The first player to send this message is the winner
+    opponent_state.winner = True
+    opponent_state.finished = True
+    # Update with their final, accurate stats
+    opponent_state.wpm = wpm
+    opponent_state.accuracy = accuracy / 10
+    opponent_state.progress = 100
+    return True
+
+# The handler for each message, indexed by its tag byte (in TAG_ order)
+MESSAGE_HANDLERS = (None, handle_join, handle_start, handle_progress, handle_gameover)
+
+def handle_message(client, userdata, payload):
+    """ Decodes a message payload and applies it to the game state.
+    Returns True if it changed the opponent's stats shown on screen. """
     try:
-        payload = msg.payload.decode()
-        data = json.loads(payload)
-
-        # Ignore messages sent by ourselves (if broker echoes them)
-        if data.get("sender_name") == player_name:
-            return
-
-        # Host receives join message with player name from client
-        if data.get("action") == "join" and userdata["is_host"]:
-            opponent_state["name"] = data.get("name", "Opponent")
-            text_to_send = json.dumps({
-                "action": "start_game",
-                "sender_name": player_name,
-                "text": userdata["game_text"],
-                "name": player_name
-            })
-            client.publish(userdata["topic"], text_to_send)
-            game_started_event.set()
-
-        # Client receives the game text and host's name
-        elif data.get("action") == "start_game" and not userdata["is_host"]:
-            game_text = data["text"]
-            opponent_state["name"] = data.get("name", "Opponent")
-            game_started_event.set()
-
-        elif data.get("action") == "progress_update":
-            state_data = data.get("state", {})
-            # Only update running stats if the opponent isn't marked as finished yet
-            if not opponent_state["finished"]:
-                opponent_state.update(state_data)
-            # If the loser sends a final update saying they are finished, mark them as such
-            if state_data.get("finished"):
-                opponent_state["finished"] = True
-
-        elif data.get("action") == "player_finished":
-            # The first player to send this message is the winner
-            opponent_state["winner"] = True
-            opponent_state["finished"] = True
-            # Update with their final, accurate stats
-            opponent_state["wpm"] = data.get("final_wpm", opponent_state["wpm"])
-            opponent_state["accuracy"] = data.get("final_accuracy", opponent_state["accuracy"])
-            opponent_state["progress"] = 100
-
-    except (json.JSONDecodeError, UnicodeDecodeError):
-        pass
+        tag = payload[0]
+        handler = MESSAGE_HANDLERS[tag] if tag < len(MESSAGE_HANDLERS) else None
+        if handler is not None:
+            return handler(client, userdata, payload)
+    except (IndexError, ValueError, KeyError, TypeError, struct.error):
+        pass # Malformed or undecodable message
+    return False
 
 # --- Leaderboard Logic ---
 def load_leaderboard():
@@ -102,37 +209,40 @@ def load_leaderboard():
     if not os.path.exists(LEADERBOARD_FILE):
         return []
     try:
-        with open(LEADERBOARD_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
+        with open(LEADERBOARD_FILE, 'rb') as f:
+            return json_loads(f.read())
+    except (ValueError, IOError): # ValueError covers both decoders' JSONDecodeError
         return []
 
 def save_leaderboard(leaderboard):
     """ Saves the leaderboard to a JSON file. """
     try:
-        with open(LEADERBOARD_FILE, 'w') as f:
-            json.dump(leaderboard, f, indent=4)
+        with open(LEADERBOARD_FILE, 'wb') as f:
+            f.write(json_dumps_indented(leaderboard))
     except IOError:
         pass # Fail silently if we can't write the file
 
 def update_leaderboard(name, wpm, accuracy):
-    """ Adds a new score to the leaderboard and keeps it sorted and trimmed. """
+    """ Adds a new score to the leaderboard, keeps it sorted and trimmed, and returns it. """
     leaderboard = load_leaderboard()
+    t = time.localtime()
     leaderboard.append({
         "name": name,
         "wpm": wpm,
         "accuracy": accuracy,
-        "date": datetime.now().strftime("%Y-%m-%d %H:%M")
+        "date": f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}"
     })
-    # Sort by WPM (descending), then by accuracy (descending)
-    leaderboard.sort(key=lambda x: (x['wpm'], x['accuracy']), reverse=True)
-    save_leaderboard(leaderboard[:10]) # Keep only the top 10
+    # Keep only the top 10 by WPM (descending), then by accuracy (descending)
+    leaderboard = heapq.nlargest(10, leaderboard, key=lambda x: (x['wpm'], x['accuracy']))
+    save_leaderboard(leaderboard)
+    return leaderboard
 
-def draw_leaderboard(stdscr):
-    """ Renders the leaderboard on the screen and waits for a key press. """
+def draw_leaderboard(stdscr, leaderboard=None):
+    """ Renders the leaderboard (loaded from disk if not given) and waits for a key press. """
     stdscr.erase()
     h, w = stdscr.getmaxyx()
-    leaderboard = load_leaderboard()
+    if leaderboard is None:
+        leaderboard = load_leaderboard()
 
     title = "--- Leaderboard (Top 10) ---"
     stdscr.addstr(2, (w - len(title)) // 2, title, curses.A_BOLD)
@@ -158,170 +268,287 @@ def draw_leaderboard(stdscr):
 
 # --- Curses UI and Game Logic ---
 def draw_ui(stdscr, state):
-    """ Renders the game UI in the terminal, now with text wrapping. """
-    stdscr.erase()
+    """ Renders the game UI in the terminal, repainting only what changed since the last frame. """
     h, w = stdscr.getmaxyx()
     start_y, start_x = 4, 4
     max_line_width = w - start_x - 2
     if max_line_width <= 0:
+        stdscr.erase()
         stdscr.addstr(0, 0, "Terminal is too small!")
         stdscr.refresh()
+        state["drawn_screen"] = None
         return
 
-    stdscr.addstr(2, 2, "Type the following text:")
-    for i in range(0, len(game_text), max_line_width):
-        line_num = i // max_line_width
-        draw_y = start_y + line_num
-        if draw_y >= h - 6:
-            break
-        stdscr.addstr(draw_y, start_x, game_text[i:i + max_line_width])
-
-    for i, char in enumerate(state['current_text']):
-        line_num = i // max_line_width
-        char_pos = i % max_line_width
-        draw_y = start_y + line_num
-        draw_x = start_x + char_pos
+    # The finish messages are drawn over the text, so a change in the finish
+    # status needs a full repaint just like a resize does.
+    status = (state["finished"], opponent_state.finished, opponent_state.winner)
+    full_repaint = state["drawn_screen"] != (h, w, status)
+    if full_repaint:
+        stdscr.erase()
+        stdscr.addstr(2, 2, "Type the following text:")
+        if wrap_cache["width"] != max_line_width:
+            wrap_cache["width"] = max_line_width
+            wrap_cache["lines"] = [game_text[i:i + max_line_width]
+                                   for i in range(0, game_text_len, max_line_width)]
+            wrap_cache["rows"] = [start_y + i // max_line_width for i in range(game_text_len)]
+            wrap_cache["cols"] = [start_x + i % max_line_width for i in range(game_text_len)]
+        for line_num, line in enumerate(wrap_cache["lines"]):
+            draw_y = start_y + line_num
+            if draw_y >= h - 6:
+                break
+            stdscr.addstr(draw_y, start_x, line)
+        stdscr.addstr(h - 5, 2, "-" * (w - 4))
+        state["drawn_screen"] = (h, w, status)
+        state["drawn_len"] = 0
+        state["redraw_from"] = 0
+        state["drawn_stats"] = None
+
+    # Cells in [redraw_from, drawn_len) may have been deleted or retyped since the
+    # last frame: put the prompt back on the deleted ones and repaint the typed ones.
+    buf = state['current_buf']
+    typed_len = len(buf)
+    drawn_len = state["drawn_len"]
+    redraw_from = min(state["redraw_from"], drawn_len)
+    redraw_to = max(typed_len, drawn_len)
+    correct_attr, wrong_attr = curses.color_pair(1), curses.color_pair(2)
+    rows, cols = wrap_cache["rows"], wrap_cache["cols"]
+    # Group the cells into runs of one color on one line, so each run is a
+    # single addstr call instead of one call per character. Cells are
+    # classified with integer byte compares; text is only sliced per run.
+    # Runs also break at drawn_len: cells from there on still show the prompt.
+    runs = [] # [first cell index, attribute]
+    for i in range(redraw_from, redraw_to):
+        if i >= typed_len:
+            attr = curses.A_NORMAL
+        elif buf[i] == game_text_bytes[i]:
+            attr = correct_attr
+        else:
+            attr = wrong_attr
+        if not (runs and runs[-1][1] == attr and cols[i] != start_x and i != drawn_len):
+            runs.append([i, attr])
+    for n, (first, attr) in enumerate(runs):
+        draw_y = rows[first]
         if draw_y >= h - 6:
             break
-        correct_char = game_text[i]
-        color = curses.color_pair(1) if char == correct_char else curses.color_pair(2)
-        stdscr.addstr(draw_y, draw_x, char, color)
-
-    stdscr.addstr(h - 5, 2, "-" * (w - 4))
-    my_stats = f"{player_name} (You) -> WPM: {state['wpm']:.0f} | Progress: {state['progress']:.0f}% | Accuracy: {state['accuracy']:.1f}%"
-    opp_stats = f"{opponent_state['name']} -> WPM: {opponent_state['wpm']:.0f} | Progress: {opponent_state['progress']:.0f}% | Accuracy: {opponent_state['accuracy']:.1f}%"
-    stdscr.addstr(h - 4, 4, my_stats)
-    stdscr.addstr(h - 3, 4, opp_stats)
-
-    if state["finished"]:
+        last = runs[n + 1][0] if n + 1 < len(runs) else redraw_to
+        draw_x = cols[first]
+        if attr == correct_attr and first >= drawn_len:
+            # The prompt glyphs are already on screen, so only recolor them
+            stdscr.chgat(draw_y, draw_x, last - first, attr)
+            continue
+        # Untyped and correctly typed cells both show the prompt text
+        if attr == wrong_attr:
+            text = buf[first:last].decode('ascii', 'replace')
+        else:
+            text = game_text[first:last]
+        stdscr.addstr(draw_y, draw_x, text, attr)
+    state["drawn_len"] = typed_len
+    state["redraw_from"] = typed_len
+
+    # Most frames only tick the WPM, so leave the stats lines alone (and skip
+    # formatting them) unless the rounded numbers they show have changed.
+    # round() rounds the same way as the :.0f and :.1f formats below.
+    stats_key = (round(state['wpm']), round(state['progress']), round(state['accuracy'], 1),
+                 round(opponent_state.wpm), round(opponent_state.progress), round(opponent_state.accuracy, 1))
+    stats_changed = state["drawn_stats"] != stats_key
+    if stats_changed:
+        my_stats = f"{player_name} (You) -> WPM: {state['wpm']:.0f} | Progress: {state['progress']:.0f}% | Accuracy: {state['accuracy']:.1f}%"
+        opp_stats = f"{opponent_state.name} -> WPM: {opponent_state.wpm:.0f} | Progress: {opponent_state.progress:.0f}% | Accuracy: {opponent_state.accuracy:.1f}%"
+        stdscr.addstr(h - 4, 4, my_stats)
+        stdscr.clrtoeol()
+        stdscr.addstr(h - 3, 4, opp_stats)
+        stdscr.clrtoeol()
+        state["drawn_stats"] = stats_key
+
+    # The finish messages only change with the finish status, which forces a full repaint
+    if full_repaint and state["finished"]:
         finish_msg = f"You finished in {state['finish_time']:.2f} seconds!"
         stdscr.addstr(h // 2 - 1, (w - len(finish_msg)) // 2, finish_msg, curses.A_BOLD)
         
-        if not opponent_state["finished"]:
+        if not opponent_state.finished:
             wait_msg = "Waiting for opponent to finish..."
             stdscr.addstr(h // 2 + 1, (w - len(wait_msg)) // 2, wait_msg)
         else: # Both players are finished
-            if opponent_state["winner"]:
+            if opponent_state.winner:
                 msg = "You lose! Better luck next time."
             else:
                  msg = "You are the winner!"
             stdscr.addstr(h // 2 + 1, (w - len(msg)) // 2, msg)
             stdscr.addstr(h // 2 + 3, (w - 36) // 2, "Game finished. Preparing leaderboard...")
 
+    if full_repaint or runs or stats_changed:
+        stdscr.refresh()
 
-    stdscr.refresh()
-
-def calculate_stats(state):
-    """ Calculates WPM, progress, and accuracy. """
-    if not state['start_time']:
+def calculate_stats(state, now_ns):
+    """ Calculates WPM, progress, and accuracy as of the monotonic time `now_ns`. """
+    if state['start_ns'] is None:
         return
     
-    elapsed_time = time.time() - state['start_time']
-    if elapsed_time > 0:
-        state['wpm'] = (len(state['current_text']) / 5) / (elapsed_time / 60)
+    typed = len(state['current_buf'])
+    elapsed_ns = now_ns - state['start_ns']
+    if elapsed_ns > 0:
+        state['wpm'] = typed * WPM_FACTOR / elapsed_ns
     
-    state['progress'] = (len(state['current_text']) / len(game_text)) * 100
+    state['progress'] = typed * progress_per_char
     
-    errors = sum(1 for i, char in enumerate(state['current_text']) if char != game_text[i])
-    state['accuracy'] = ((len(state['current_text']) - errors) / len(state['current_text'])) * 100 if state['current_text'] else 100
-
-def main_game_loop(stdscr, client, topic):
+    state['accuracy'] = ((typed - state['error_count']) / typed) * 100 if typed else 100
+
+def pack_stats(tag, flags, wpm, progress, accuracy, into=None):
+    """ Packs a TAG_PROGRESS or TAG_GAMEOVER message in STATS_PACKET's units,
+    overwriting the bytearray `into` instead of returning new bytes if given. """
+    fields = (tag, flags, min(round(wpm), 0xFFFF), round(progress * 10), round(accuracy * 10))
+    if into is None:
+        return STATS_PACKET.pack(*fields)
+    STATS_PACKET.pack_into(into, 0, *fields)
+    return into
+
+def main_game_loop(stdscr, client, topic, is_host):
     """ The main game loop that handles user input and state updates. """
-    global opponent_state
-    
     curses.init_pair(1, curses.COLOR_GREEN, curses.COLOR_BLACK)
     curses.init_pair(2, curses.COLOR_RED, curses.COLOR_BLACK)
-    stdscr.nodelay(True)
+    stdscr.timeout(0) # The loop sets how long getch waits at the end of each iteration
 
     state = {
-        "current_text": "", "wpm": 0, "progress": 0, "accuracy": 100,
-        "start_time": None, "finished": False, "finish_time": None
+        "current_buf": bytearray(), "error_count": 0, "wpm": 0, "progress": 0, "accuracy": 100,
+        "start_ns": None, "finished": False, "finish_time": None,
+        # draw_ui bookkeeping: what is on screen and which typed cells are stale
+        "drawn_screen": None, "drawn_len": 0, "redraw_from": 0, "drawn_stats": None
     }
 
-    last_update_time = 0
+    next_update_ns = 0
+    # Progress updates are packed into these two buffers in turn, so the one
+    # last sent is kept for comparison without allocating a packet per tick.
+    # paho copies a QoS 0 payload into the outgoing packet during publish(),
+    # so a buffer can be overwritten as soon as publish() returns.
+    progress_payload = bytearray(STATS_PACKET.size)
+    last_progress_payload = bytearray(STATS_PACKET.size) # Tag 0: differs from any real update
+    last_draw_ns = 0
+    dirty = True
+
+    userdata = client.user_data_get()
+    sender_flags = STATS_FROM_HOST if is_host else 0
 
     while True:
-        # --- Handle Input (only if player hasn't finished) ---
-        if not state["finished"]:
+        # getch returns -1 if no key came within the timeout set below
+        ch = stdscr.getch()
+        now_ns = time.monotonic_ns() # One clock read per iteration, shared by everything below
+        stats_fresh = False # Set once calculate_stats has run for now_ns
+
+        # --- Apply messages queued by the network thread ---
+        # Before the key is handled, so the win check below knows whether
+        # the opponent's game-over arrived while getch was waiting.
+        while True:
             try:
-                key = stdscr.getkey()
-                if state["start_time"] is None:
-                    state["start_time"] = time.time()
-
-                if key in ("KEY_BACKSPACE", '\b', '\x7f'):
-                    if state["current_text"]:
-                        state["current_text"] = state["current_text"][:-1]
-                elif len(key) == 1:
-                    state["current_text"] += key
+                payload = received_messages.get_nowait()
+            except queue.Empty:
+                break
+            if handle_message(client, userdata, payload):
+                dirty = True
+
+        # --- Handle Input (only if player hasn't finished) ---
+        if ch != -1 and not state["finished"]:
+            dirty = True
+            if state["start_ns"] is None:
+                state["start_ns"] = now_ns
+
+            # error_count tracks mismatched characters as they are typed and
+            # deleted, so calculate_stats never has to rescan the text.
+            if ch in (curses.KEY_BACKSPACE, 8, 127):
+                if state["current_buf"]:
+                    idx = len(state["current_buf"]) - 1
+                    if state["current_buf"][idx] != game_text_bytes[idx]:
+                        state["error_count"] -= 1
+                    del state["current_buf"][-1]
+                    state["redraw_from"] = min(state["redraw_from"], idx)
+            elif 32 <= ch < 127 and len(state["current_buf"]) < game_text_len:
+                idx = len(state["current_buf"])
+                if ch != game_text_bytes[idx]:
+                    state["error_count"] += 1
+                state["current_buf"].append(ch)
+            
+            calculate_stats(state, now_ns)
+            stats_fresh = True
+
+            # --- Check for local win condition ---
+            # The length guard settles almost every keystroke with one integer
+            # compare; only a full-length buffer is compared byte for byte.
+            if len(state["current_buf"]) == game_text_len and state["current_buf"] == game_text_bytes:
+                state["finished"] = True
+                state["finish_time"] = (now_ns - state["start_ns"]) / 1e9
+                # The stats computed above for this keystroke are the final ones
                 
-                calculate_stats(state)
-
-                # --- Check for local win condition ---
-                if state["current_text"] == game_text:
-                    state["finished"] = True
-                    state["finish_time"] = time.time() - state["start_time"]
-                    calculate_stats(state) # Final calculation before sending
-                    
-                    if not opponent_state["winner"]:
-                        # We are the winner. Send the definitive "player_finished" message.
-                        win_message = json.dumps({
-                            "action": "player_finished",
-                            "sender_name": player_name,
-                            "final_wpm": state["wpm"],
-                            "final_accuracy": state["accuracy"]
-                        })
-                        client.publish(topic, win_message)
-                    else:
-                        # We are the loser. The opponent has already won.
-                        # Send a final progress update to let them know we are done.
-                        final_progress = {
-                            "action": "progress_update",
-                            "sender_name": player_name,
-                            "state": {
-                                "wpm": state["wpm"],
-                                "progress": 100,
-                                "accuracy": state["accuracy"],
-                                "finished": True # This is the crucial flag for the winner
-                            }
-                        }
-                        client.publish(topic, json.dumps(final_progress))
-
-            except curses.error:
-                pass # No input
+                if not opponent_state.winner:
+                    # We are the winner. Send TAG_GAMEOVER (with STATS_FINISHED) and our final stats.
+                    win_message = pack_stats(TAG_GAMEOVER, sender_flags | STATS_FINISHED,
+                                             state["wpm"], 100, state["accuracy"])
+                    client.publish(topic, win_message, qos=1)
+                else:
+                    # We are the loser. The opponent has already won.
+                    # Send a final progress update to let them know we are done.
+                    # Its finished flag is the crucial signal for the winner.
+                    final_progress = pack_stats(TAG_PROGRESS, sender_flags | STATS_FINISHED,
+                                                state["wpm"], 100, state["accuracy"])
+                    client.publish(topic, final_progress, qos=1)
 
         # --- Check for game over condition for BOTH players ---
-        if state["finished"] and opponent_state["finished"]:
+        if state["finished"] and opponent_state.finished:
+            game_over_event.set()
+            client.unsubscribe(topic) # The broker can stop sending us the opponent's messages
             break # Exit the main loop
 
         # --- Send periodic progress updates ---
-        if time.time() - last_update_time > 0.2:
-            if not state["finished"]: # Don't send updates after finishing
-                calculate_stats(state)
-            
-            progress_data = { "action": "progress_update",
-                "sender_name": player_name,
-                "state": { "wpm": state["wpm"], "progress": state["progress"], "accuracy": state["accuracy"] }
-            }
-            client.publish(topic, json.dumps(progress_data))
-            last_update_time = time.time()
-        
-        draw_ui(stdscr, state)
-        time.sleep(0.01)
+        if now_ns >= next_update_ns:
+            # Recompute so the WPM falls while idle, unless a key already did this iteration
+            if not state["finished"] and not stats_fresh: # Stats are frozen after finishing
+                calculate_stats(state, now_ns)
+
+            # Progress is fire-and-forget (QoS 0) and only sent when it changed;
+            # losing one only delays the opponent's view until the next. The
+            # messages that end the game are sent at QoS 1 above, since the
+            # opponent waits for them.
+            # The packet holds whole WPM, so a WPM drifting by fractions while
+            # we pause doesn't count as a change.
+            pack_stats(TAG_PROGRESS, sender_flags, state["wpm"], state["progress"],
+                       state["accuracy"], into=progress_payload)
+            if progress_payload != last_progress_payload:
+                client.publish(topic, progress_payload, qos=0)
+                progress_payload, last_progress_payload = last_progress_payload, progress_payload
+            # Advance on a fixed grid so the ticks don't drift later each time,
+            # but resync after a stall instead of firing a burst of catch-up ticks.
+            next_update_ns += PROGRESS_INTERVAL_NS
+            if next_update_ns <= now_ns:
+                next_update_ns = now_ns + PROGRESS_INTERVAL_NS
+            dirty = True # Refresh the WPM shown on screen as time passes
+
+        # --- Redraw only when something changed, capped at FRAME_INTERVAL_NS ---
+        if dirty and now_ns - last_draw_ns >= FRAME_INTERVAL_NS:
+            draw_ui(stdscr, state)
+            last_draw_ns = now_ns
+            dirty = False
+
+        # Wait in getch for the next key, but only until the next pending redraw
+        # or progress tick is due, and never more than a frame so messages
+        # queued by the network thread are picked up promptly.
+        wait_ns = min(FRAME_INTERVAL_NS, next_update_ns - now_ns)
+        if dirty:
+            wait_ns = min(wait_ns, last_draw_ns + FRAME_INTERVAL_NS - now_ns)
+        stdscr.timeout(max(0, -(-wait_ns // 1_000_000))) # Round up to whole milliseconds
     
     # --- Game Over Sequence (after loop breaks) ---
     draw_ui(stdscr, state) # Show final win/loss message
     time.sleep(2)
 
     # Save winner's score to leaderboard
-    if not opponent_state["winner"]:
-        update_leaderboard(player_name, state["wpm"], state["accuracy"])
+    leaderboard = None
+    if not opponent_state.winner:
+        leaderboard = update_leaderboard(player_name, state["wpm"], state["accuracy"])
 
     client.disconnect()
-    draw_leaderboard(stdscr)
+    draw_leaderboard(stdscr, leaderboard)
 
 def main(stdscr):
     """ Main entry point to get player name, set up connection, and start the game. """
-    global game_text, player_name
+    global player_name
     
     curses.echo()
     stdscr.clear()
@@ -344,7 +571,7 @@ def main(stdscr):
         key = stdscr.getkey()
         if key == '1':
             is_host = True
-            game_text = random.choice(TEXT_TO_TYPE)
+            set_game_text(random.choice(TEXT_TO_TYPE))
             unique_id = str(uuid.uuid4()).split('-')[0]
             topic = f"typing-game/{unique_id}"
             stdscr.clear()
@@ -367,7 +594,12 @@ def main(stdscr):
             stdscr.refresh()
             break
 
-    user_data = {"topic": topic, "is_host": is_host, "game_text": game_text}
+    # The host's start message never changes, so encode it before connecting
+    # instead of on the network thread when the opponent joins.
+    start_message = None
+    if is_host:
+        start_message = b'%c{"n":%s,"t":%s}' % (TAG_START, json_dumps(player_name), json_dumps(game_text))
+    user_data = {"topic": topic, "is_host": is_host, "start_message": start_message}
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=user_data)
     client.on_connect = on_connect
     client.on_message = on_message
@@ -380,7 +612,7 @@ def main(stdscr):
     if is_host:
         game_started_event.wait(timeout=120)
     else:
-        join_msg = json.dumps({"action": "join", "name": player_name, "sender_name": player_name})
+        join_msg = bytes([TAG_JOIN]) + player_name.encode('utf-8')
         client.publish(topic, join_msg)
         game_started_event.wait(timeout=120)
 
@@ -391,7 +623,7 @@ def main(stdscr):
         stdscr.nodelay(False)
         stdscr.getch()
     else:
-        main_game_loop(stdscr, client, topic)
+        main_game_loop(stdscr, client, topic, is_host)
 
 if __name__ == "__main__":
     curses.wrapper(main)
\ No newline at end of file